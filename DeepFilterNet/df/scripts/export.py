@@ -1,5 +1,8 @@
+import json
 import os
 import shutil
+import subprocess
+import sys
 import tarfile
 from copy import deepcopy
 from pathlib import Path
@@ -25,6 +28,15 @@ from df.enhance import (
 from df.io import get_test_sample, save_audio
 from libdf import DF
 
+ORT_OPT_LEVELS = {
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+# Grow the arena only by the requested size instead of the next power of two. This results in
+# more, smaller extensions but less over-allocated memory.
+ORT_PROVIDERS = [("CPUExecutionProvider", {"arena_extend_strategy": "kSameAsRequested"})]
+
 
 def shapes_dict(
     tensors: Tuple[Tensor], names: Union[Tuple[str], List[str]]
@@ -36,8 +48,35 @@ def shapes_dict(
     return {k: v.shape for (k, v) in zip(names, tensors)}
 
 
+def onnx_input_feed(input_dict: Dict[str, Tensor]) -> Dict[str, np.ndarray]:
+    # Zero-copy for CPU tensors without grad; only detach/copy otherwise
+    return {
+        k: v.numpy() if v.device.type == "cpu" and not v.requires_grad else v.detach().cpu().numpy()
+        for (k, v) in input_dict.items()
+    }
+
+
+def onnx_compare(
+    output_names: List[str],
+    outputs: Tuple[Tensor, ...],
+    onnx_outputs: List[np.ndarray],
+    rtol: float = 1e-6,
+    atol: float = 1e-5,
+):
+    for name, out, onnx_out in zip(output_names, outputs, onnx_outputs):
+        try:
+            np.testing.assert_allclose(
+                out.numpy().squeeze(), onnx_out.squeeze(), rtol=rtol, atol=atol
+            )
+        except AssertionError as e:
+            logger.warning(f"  Elements not close for {name}: {e}")
+
+
 def onnx_simplify(
-    path: str, input_data: Dict[str, Tensor], input_shapes: Dict[str, Iterable[int]]
+    path: str,
+    input_data: Dict[str, Tensor],
+    input_shapes: Dict[str, Iterable[int]],
+    full_check: bool = False,
 ) -> str:
     import onnxsim
 
@@ -51,7 +90,7 @@ def onnx_simplify(
     assert check, "Simplified ONNX model could not be validated"
     logger.debug(model_n + ": " + onnx.helper.printable_graph(model.graph))
     try:
-        onnx.checker.check_model(model_simp, full_check=True)
+        onnx.checker.check_model(model_simp, full_check=full_check)
     except Exception as e:
         logger.error(f"Failed to simplify model {model_n}. Skipping: {e}")
         return path
@@ -60,12 +99,220 @@ def onnx_simplify(
     return path
 
 
-def onnx_check(path: str, input_dict: Dict[str, Tensor], output_names: Tuple[str]):
-    model = onnx.load(path)
+def onnx_convert_fp16(path: str) -> str:
+    """Store weights in fp16 while keeping fp32 model inputs and outputs.
+
+    On the CPU execution provider, most operators (e.g. GRU) have no fp16 kernels. ORT then inserts
+    casts and computes in fp32, which may be slower than the fp32 model.
+    """
+    from onnxconverter_common import float16
+
+    model = float16.convert_float_to_float16(
+        onnx.load(path), keep_io_types=True, disable_shape_infer=False
+    )
+    onnx.save_model(model, path)
+    return path
+
+
+def onnx_quantize(path: str) -> str:
+    """Dynamically quantize MatMul/Gemm weights to signed int8.
+
+    Conv layers are kept in fp32 since QLinearConv is not faster on the CPU EP for our filter
+    sizes. Signed symmetric weights allow ORT to fuse into MatMulIntegerToFloat, which uses the
+    VNNI int8 dot-product kernels on recent x86 CPUs.
+    """
+    from onnxruntime.quantization import QuantType, quant_pre_process, quantize_dynamic
+
+    quant_pre_process(path, path, skip_symbolic_shape=False)
+    quantize_dynamic(
+        path,
+        path,
+        weight_type=QuantType.QInt8,
+        op_types_to_quantize=["MatMul", "Gemm"],
+        extra_options={
+            "MatMulConstBOnly": True,
+            "EnableSubgraph": True,
+            "WeightSymmetric": True,
+            "ActivationSymmetric": False,
+        },
+    )
+    return path
+
+
+def onnx_quantize_int4(path: str, block_size: int = 32) -> str:
+    """Block-wise quantize MatMul weights to int4 using ORT's MatMulNBits contrib operator.
+
+    Only `MatMul` nodes are rewritten. Weights of ONNX `GRU` nodes, the largest weights in our
+    models, stay in fp32; the ERB decoder contains no `MatMul` and is left unchanged.
+    Requires onnxruntime>=1.17, recent versions additionally need the `onnx-ir` package. The
+    resulting model is not supported by tract.
+    """
+    try:
+        from onnxruntime.quantization.matmul_nbits_quantizer import (
+            MatMulNBitsQuantizer as MatMul4BitsQuantizer,
+        )
+    except ModuleNotFoundError as e:
+        # onnxruntime<1.22 only ships the 4 bit specific quantizer
+        if e.name != "onnxruntime.quantization.matmul_nbits_quantizer":
+            raise
+        from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer
+
+    quant = MatMul4BitsQuantizer(onnx.load(path), block_size=block_size, is_symmetric=True)
+    quant.process()
+    quant.model.save_model_to_file(path)
+    return path
+
+
+def onnx_to_ort(path: str, target_platform: str = "amd64", opt_level: str = "extended") -> str:
+    """Convert an ONNX model to the ORT format for the given target platform.
+
+    The target platform determines which (quantized) kernels are assumed to be available, e.g.
+    ARM NEON dot-product kernels for `arm`. The graph optimizations of `opt_level` are baked
+    into the ORT model.
+    """
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "onnxruntime.tools.convert_onnx_models_to_ort",
+            path,
+            "--optimization_style",
+            "Fixed",
+            "--target_platform",
+            target_platform,
+        ],
+        check=True,
+        env={**os.environ, "ORT_CONVERT_ONNX_MODELS_TO_ORT_OPTIMIZATION_LEVEL": opt_level},
+    )
+    # The converter adds the optimization level to the file name unless it is 'all'
+    suffix = ".ort" if opt_level == "all" else f".{opt_level}.ort"
+    return os.path.splitext(path)[0] + suffix
+
+
+def ort_session_options(
+    opt_level: str = "extended", intra_op_num_threads: int = 0, allow_spinning: bool = False
+) -> ort.SessionOptions:
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ORT_OPT_LEVELS[opt_level]
+    sess_options.intra_op_num_threads = intra_op_num_threads
+    # Don't busy-wait in the thread pools between the short, latency sensitive runs
+    spinning = "1" if allow_spinning else "0"
+    sess_options.add_session_config_entry("session.intra_op.allow_spinning", spinning)
+    sess_options.add_session_config_entry("session.inter_op.allow_spinning", spinning)
+    return sess_options
+
+
+def onnx_check(
+    path: str,
+    input_dict: Dict[str, Tensor],
+    output_names: Tuple[str],
+    opt_level: str = "extended",
+    full_check: bool = False,
+):
+    # Weights are not needed for validation; ORT resolves external data relative to the path
+    model = onnx.load(path, load_external_data=False)
     logger.debug(os.path.basename(path) + ": " + onnx.helper.printable_graph(model.graph))
-    onnx.checker.check_model(model, full_check=True)
-    sess = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
-    return sess.run(output_names, {k: v.numpy() for (k, v) in input_dict.items()})
+    if full_check:
+        # Full check runs shape inference over the whole graph again, which the export already did
+        onnx.checker.check_model(path, full_check=True)
+    else:
+        onnx.checker.check_model(model)
+    sess = ort.InferenceSession(
+        path,
+        sess_options=ort_session_options(opt_level),
+        providers=ORT_PROVIDERS,
+    )
+    return sess.run(output_names, onnx_input_feed(input_dict))
+
+
+def ort_io_binding(
+    sess: ort.InferenceSession, input_feed: Dict[str, np.ndarray], output_names: Tuple[str]
+) -> Tuple[ort.IOBinding, List[ort.OrtValue]]:
+    """Bind inputs and pre-allocated outputs to avoid per-run allocations and copies.
+
+    Returns:
+        io (IOBinding): Binding to be used with `run_with_iobinding`.
+        values (List[OrtValue]): Bound input and output values. The binding does not keep them
+            alive, thus they must be referenced for as long as `io` is used.
+    """
+    outputs = sess.run(output_names, input_feed)
+    io = sess.io_binding()
+    values = []
+    for k, v in input_feed.items():
+        values.append(ort.OrtValue.ortvalue_from_numpy(v, "cpu"))
+        io.bind_ortvalue_input(k, values[-1])
+    for k, v in zip(output_names, outputs):
+        # OrtValue wraps the numpy buffer without copying and holds a reference to it
+        values.append(ort.OrtValue.ortvalue_from_numpy(np.empty_like(v), "cpu"))
+        io.bind_ortvalue_output(k, values[-1])
+    return io, values
+
+
+def onnx_benchmark(
+    path: str,
+    input_dict: Dict[str, Tensor],
+    output_names: Tuple[str],
+    opt_level: str = "extended",
+    min_run_time: float = 3.0,
+) -> Tuple[int, bool]:
+    """Benchmark the ONNX model for multiple intra-op thread counts with and without spinning.
+
+    The fastest setting is stored next to the model in `<model>_benchmark.json`.
+
+    Returns:
+        intra_op_num_threads (int): Intra-op thread count with the lowest median run time.
+        allow_spinning (bool): Whether thread pool spinning was enabled for the fastest run.
+    """
+    import torch.utils.benchmark as benchmark
+
+    n_threads = sorted({1, 2, 4, max(1, min(8, (os.cpu_count() or 1) // 2))})
+    # A single thread has no thread pool, thus spinning only matters for multiple threads
+    configs = [(n, spin) for n in n_threads for spin in (False, True) if n > 1 or not spin]
+    input_feed = onnx_input_feed(input_dict)
+    timings = {}
+    for intra, spin in configs:
+        sess = ort.InferenceSession(
+            path,
+            sess_options=ort_session_options(
+                opt_level, intra_op_num_threads=intra, allow_spinning=spin
+            ),
+            providers=ORT_PROVIDERS,
+        )
+        io, io_values = ort_io_binding(sess, input_feed, output_names)
+
+        # Bind via default args to avoid closure/attribute lookups in the timed call. The bound
+        # values are passed along to keep them alive while the timer runs.
+        def run_onnx(run=sess.run_with_iobinding, io=io, io_values=io_values):
+            run(io)
+
+        # Keep torch at a single thread to only measure the effect of the ORT intra-op threads
+        timer = benchmark.Timer(stmt="run_onnx()", globals={"run_onnx": run_onnx}, num_threads=1)
+        timings[(intra, spin)] = timer.blocked_autorange(min_run_time=min_run_time).median
+    best_intra, best_spin = min(timings, key=timings.__getitem__)
+    model_n = os.path.splitext(os.path.basename(path))[0]
+    logger.info(f"  Benchmark results for {model_n} (opt level: {opt_level}):")
+    for (intra, spin), t in timings.items():
+        logger.info(
+            f"    intra_op_num_threads={intra:<2} allow_spinning={spin:d}: {t * 1000:.3f} ms"
+        )
+    logger.info(
+        f"  Fastest setting: intra_op_num_threads={best_intra}, allow_spinning={best_spin}"
+    )
+    with open(os.path.splitext(path)[0] + "_benchmark.json", "w") as f:
+        json.dump(
+            {
+                "intra_op_num_threads": best_intra,
+                "allow_spinning": best_spin,
+                "opt_level": opt_level,
+                "timings": [
+                    {"intra_op_num_threads": intra, "allow_spinning": spin, "median_ms": t * 1000}
+                    for (intra, spin), t in timings.items()
+                ],
+            },
+            f,
+            indent=2,
+        )
+    return best_intra, best_spin
 
 
 def export_impl(
@@ -76,10 +323,15 @@ def export_impl(
     output_names: List[str],
     dynamic_axes: Dict[str, Dict[int, str]],
     jit: bool = True,
+    jit_mode: str = "script",
     opset_version=14,
+    run_benchmark: bool = False,
     check: bool = True,
+    full_check: bool = False,
     simplify: bool = True,
     print_graph: bool = False,
+    precision: str = "fp32",
+    opt_level: str = "extended",
 ):
     export_dir = os.path.dirname(path)
     if not os.path.isdir(export_dir):
@@ -95,8 +347,12 @@ def export_impl(
     output_shapes = shapes_dict(outputs, output_names)
     logger.info(f"  Output shapes: {output_shapes}")
 
-    if jit:
+    if jit and jit_mode == "script":
         model = torch.jit.script(model, example_inputs=[tuple(a for a in inputs)])
+    elif jit and jit_mode == "trace":
+        # Tracing yields a flat graph without If/Loop subgraphs; only valid if the module has no
+        # data dependent control flow.
+        model = torch.jit.trace(model, inputs, check_trace=False, strict=False)
 
     logger.info(f"  Dynamic axis: {dynamic_axes}")
     torch.onnx.export(
@@ -109,20 +365,41 @@ def export_impl(
         opset_version=opset_version,
         keep_initializers_as_inputs=False,
     )
+    # Weights and buffers must end up as initializers, not graph inputs, so that they can be
+    # quantized and prepacked by ORT
+    graph_inputs = {i.name for i in onnx.load(path, load_external_data=False).graph.input}
+    extra_inputs = graph_inputs - set(input_names)
+    assert len(extra_inputs) == 0, f"Initializers exported as graph inputs: {extra_inputs}"
 
     input_dict = {k: v for (k, v) in zip(input_names, inputs)}
     if check:
-        onnx_outputs = onnx_check(path, input_dict, tuple(output_names))
-        for name, out, onnx_out in zip(output_names, outputs, onnx_outputs):
-            try:
-                np.testing.assert_allclose(
-                    out.numpy().squeeze(), onnx_out.squeeze(), rtol=1e-6, atol=1e-5
-                )
-            except AssertionError as e:
-                logger.warning(f"  Elements not close for {name}: {e}")
+        onnx_outputs = onnx_check(
+            path, input_dict, tuple(output_names), opt_level=opt_level, full_check=full_check
+        )
+        onnx_compare(output_names, outputs, onnx_outputs)
     if simplify:
-        path = onnx_simplify(path, input_dict, shapes_dict(inputs, input_names))
+        path = onnx_simplify(
+            path, input_dict, shapes_dict(inputs, input_names), full_check=full_check
+        )
         logger.info(f"  Saved simplified model {path}")
+    if precision == "fp16":
+        path = onnx_convert_fp16(path)
+        logger.info(f"  Saved fp16 model {path}")
+    elif precision == "int8":
+        path = onnx_quantize(path)
+        logger.info(f"  Saved int8 quantized model {path}")
+    elif precision == "int4":
+        path = onnx_quantize_int4(path)
+        logger.info(f"  Saved int4 quantized model {path}")
+    if check and precision != "fp32":
+        # Make sure the converted model still loads and runs; lossy conversion requires a larger
+        # tolerance than the fp32 export
+        onnx_outputs = onnx_check(
+            path, input_dict, tuple(output_names), opt_level=opt_level, full_check=full_check
+        )
+        onnx_compare(output_names, outputs, onnx_outputs, rtol=1e-2, atol=1e-3)
+    if run_benchmark:
+        onnx_benchmark(path, input_dict, tuple(output_names), opt_level=opt_level)
     if print_graph:
         onnx.helper.printable_graph(onnx.load_model(path).graph)
 
@@ -135,10 +412,15 @@ def export(
     export_dir: str,
     df_state: DF,
     check: bool = True,
+    full_check: bool = False,
     simplify: bool = True,
     opset=14,
     export_full: bool = False,
     print_graph: bool = False,
+    precision: str = "fp32",
+    opt_level: str = "extended",
+    jit_mode: str = "script",
+    run_benchmark: bool = False,
 ):
     model = deepcopy(model).to("cpu")
     model.eval()
@@ -169,9 +451,13 @@ def export(
             dynamic_axes=dynamic_axes,
             jit=False,
             check=check,
+            full_check=full_check,
             simplify=simplify,
             opset_version=opset,
             print_graph=print_graph,
+            precision=precision,
+            opt_level=opt_level,
+            run_benchmark=run_benchmark,
         )
 
     # Export encoder
@@ -199,10 +485,15 @@ def export(
         output_names=output_names,
         dynamic_axes=dynamic_axes,
         jit=True,
+        jit_mode=jit_mode,
         check=check,
+        full_check=full_check,
         simplify=simplify,
         opset_version=opset,
         print_graph=print_graph,
+        precision=precision,
+        opt_level=opt_level,
+        run_benchmark=run_benchmark,
     )
     np.savez_compressed(
         os.path.join(export_dir, "enc_input.npz"),
@@ -249,10 +540,15 @@ def export(
         output_names=output_names,
         dynamic_axes=dynamic_axes,
         jit=True,
+        jit_mode=jit_mode,
         check=check,
+        full_check=full_check,
         simplify=simplify,
         opset_version=opset,
         print_graph=print_graph,
+        precision=precision,
+        opt_level=opt_level,
+        run_benchmark=run_benchmark,
     )
     np.savez_compressed(os.path.join(export_dir, "erb_dec_output.npz"), m=m.numpy())
 
@@ -278,20 +574,29 @@ def export(
         dynamic_axes=dynamic_axes,
         jit=False,
         check=check,
+        full_check=full_check,
         simplify=simplify,
         opset_version=opset,
         print_graph=print_graph,
+        precision=precision,
+        opt_level=opt_level,
+        run_benchmark=run_benchmark,
     )
     np.savez_compressed(os.path.join(export_dir, "df_dec_output.npz"), coefs=coefs.numpy())
 
 
 def main(args):
-    try:
-        import monkeytype  # noqa: F401
-    except ImportError:
-        print("Failed to import monkeytype. Please install it via")
-        print("$ pip install MonkeyType")
-        exit(1)
+    if args.jit_mode == "script":
+        try:
+            import monkeytype  # noqa: F401
+        except ImportError:
+            print("Failed to import monkeytype. Please install it via")
+            print("$ pip install MonkeyType")
+            exit(1)
+    if args.precision == "int4" and args.opset < 17:
+        # int4 models require ORT anyway, thus they are not bound to tract's supported opsets
+        logger.info(f"Raising ONNX opset from {args.opset} to 17 for int4 export")
+        args.opset = 17
 
     print(args)
     model, df_state, _ = init_df(
@@ -316,7 +621,12 @@ def main(args):
         df_state=df_state,
         opset=args.opset,
         check=args.check,
+        full_check=args.full_check,
         simplify=args.simplify,
+        precision=args.precision,
+        opt_level=args.opt_level,
+        jit_mode=args.jit_mode,
+        run_benchmark=args.benchmark,
     )
     model_base_dir = get_model_basedir(args.model_base_dir)
     if model_base_dir != args.export_dir:
@@ -324,11 +634,17 @@ def main(args):
             os.path.join(model_base_dir, "config.ini"),
             os.path.join(args.export_dir, "config.ini"),
         )
+    model_paths = [
+        os.path.join(args.export_dir, name + ".onnx") for name in ("enc", "erb_dec", "df_dec")
+    ]
+    if args.ort:
+        model_paths += [
+            onnx_to_ort(path, args.target_platform, args.opt_level) for path in model_paths
+        ]
     tar_name = export_dir / (Path(model_base_dir).name + "_onnx.tar.gz")
     with tarfile.open(tar_name, mode="w:gz") as f:
-        f.add(os.path.join(args.export_dir, "enc.onnx"))
-        f.add(os.path.join(args.export_dir, "erb_dec.onnx"))
-        f.add(os.path.join(args.export_dir, "df_dec.onnx"))
+        for path in model_paths:
+            f.add(path)
         f.add(os.path.join(args.export_dir, "config.ini"))
 
 
@@ -341,7 +657,59 @@ if __name__ == "__main__":
         action="store_false",
         dest="check",
     )
+    parser.add_argument(
+        "--full-check",
+        help="Run the full onnx checker including strict shape inference.",
+        action="store_true",
+    )
     parser.add_argument("--simplify", help="Simply onnx models using onnxsim.", action="store_true")
     parser.add_argument("--opset", help="ONNX opset version", type=int, default=12)
+    parser.add_argument(
+        "--precision",
+        choices=["fp32", "fp16", "int8", "int4"],
+        default="fp32",
+        help="Weight precision of the exported models. fp16 stores weights in fp16 but computes "
+        "mostly in fp32 on CPU, since ORT inserts casts for ops without fp16 CPU kernels; this "
+        "may be slower than fp32. It requires onnxconverter-common and keeps fp32 model inputs "
+        "and outputs. int8 applies dynamic quantization to "
+        "MatMul/Gemm weights; Conv layers are kept in fp32. int4 quantizes MatMul weights "
+        "block-wise via ORT's MatMulNBits operator; GRU weights stay in fp32. int4 raises the "
+        "opset to at least 17 and requires onnxruntime>=1.17 (plus onnx-ir for recent versions).",
+    )
+    parser.add_argument(
+        "--opt-level",
+        choices=list(ORT_OPT_LEVELS.keys()),
+        default="extended",
+        help="ONNX Runtime graph optimization level used for checking and benchmarking the "
+        "exported models as well as for the ORT format conversion. "
+        "Note that 'all' may regress on Intel CPUs for Conv-heavy graphs due to the NCHWc "
+        "layout transformation.",
+    )
+    parser.add_argument(
+        "--jit-mode",
+        choices=["script", "trace"],
+        default="script",
+        help="How to compile submodules before the ONNX export. 'trace' results in a flat graph "
+        "without If/Loop subgraphs, allowing more constant folding and operator fusion.",
+    )
+    parser.add_argument(
+        "--ort",
+        action="store_true",
+        help="Additionally convert the exported models to the ONNX Runtime format.",
+    )
+    parser.add_argument(
+        "--target-platform",
+        choices=["amd64", "arm"],
+        default="amd64",
+        help="Target platform for the ONNX Runtime format conversion. Use 'arm' for mobile "
+        "deployments to select the ARM optimized (quantized) kernels. Only used with --ort.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Benchmark the exported models for multiple ONNX Runtime intra-op thread counts, "
+        "with and without thread pool spinning. The fastest setting is stored as JSON next to "
+        "each model.",
+    )
     args = parser.parse_args()
     main(args)